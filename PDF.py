@@ -1,13 +1,20 @@
 import os
 import re
 import fitz
-import base64
+import asyncio
+import json
 import shutil
+import hashlib
+import threading
+import concurrent.futures
+from io import BytesIO
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timedelta
 
 # --- PDF ---
 from dotenv import load_dotenv
+import google.generativeai as genai
+from google.generativeai import caching
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.messages import HumanMessage
 from reportlab.lib.pagesizes import A4
@@ -31,6 +38,13 @@ load_dotenv()
 API_KEY = os.getenv('GOOGLE_API_KEY') 
 MODEL_NAME = "gemini-2.5-flash" 
 MAX_IMAGES = 50
+MAX_IMAGE_EDGE = 1024  # これより長辺が大きい画像は縮小してから保存・送信
+GEMINI_IMAGE_EXTS = {"png", "jpeg", "webp"}  # そのまま送信できる画像形式 (他はPNGに変換)
+GEMINI_CONCURRENCY = 5  # Geminiへの同時リクエスト数 (全PDF合計、キャプション・要約共通)
+PDF_WORKERS = 4  # 同時に処理するPDFの数
+PROMPT_CACHE_TTL = timedelta(hours=1)  # SYSTEM_PROMPTのコンテキストキャッシュ保持時間
+MAX_TEMP_IMAGES = 500  # temp_images に残す画像の上限 (超えたら古いものから削除)
+CAPTION_CACHE_PATH = 'data/caption_cache.json'  # 画像ハッシュ → キャプション
 
 DIRS = {
     'input': 'data/input_PDF',
@@ -42,6 +56,14 @@ DIRS = {
 for d in DIRS.values():
     Path(d).mkdir(parents=True, exist_ok=True)
 
+# Markdown解析用パターン (行ごとに使うためモジュール読み込み時にコンパイル)
+_BR_RE = re.compile(r'<br\s*/?>', re.IGNORECASE)
+_BOLD_RE = re.compile(r'\*\*(.*?)\*\*')
+_IMG_RE = re.compile(r'\[\[IMG:\s*(.*?)\]\]')
+_TABLE_SEP_CHARS = frozenset("|-: ")  # 表のセパレータ行 (|---|:--:|) を構成する文字
+
+genai.configure(api_key=API_KEY)
+
 llm = ChatGoogleGenerativeAI(
     model=MODEL_NAME,
     temperature=0,
@@ -128,6 +150,31 @@ SYSTEM_PROMPT = f"""
 # ==========================================
 # ユーティリティ
 # ==========================================
+def create_summary_model():
+    """SYSTEM_PROMPTをコンテキストキャッシュに載せたモデルを返す (作成できない場合はNone)"""
+    # 指示内容・モデルが変われば別キャッシュになるよう、両方のハッシュを名前に含める
+    cache_key = f"{MODEL_NAME}\0{SYSTEM_PROMPT}"
+    display_name = f"pdf-summary-{hashlib.sha1(cache_key.encode('utf-8')).hexdigest()[:16]}"
+    try:
+        cached = next((c for c in caching.CachedContent.list() if c.display_name == display_name), None)
+        if cached is None:
+            cached = caching.CachedContent.create(
+                model=f"models/{MODEL_NAME}",
+                display_name=display_name,
+                system_instruction=SYSTEM_PROMPT,
+                ttl=PROMPT_CACHE_TTL
+            )
+        else:
+            # 再利用する場合も処理中に失効しないよう保持期間を延長
+            cached.update(ttl=PROMPT_CACHE_TTL)
+        return genai.GenerativeModel.from_cached_content(
+            cached_content=cached,
+            generation_config=genai.GenerationConfig(temperature=0)
+        )
+    except Exception as e:
+        print(f"⚠️ コンテキストキャッシュ未使用: {e}")
+        return None
+
 def get_jp_font_name():
     """日本語フォントの自動検出"""
     font_paths = [
@@ -150,62 +197,194 @@ JP_FONT = get_jp_font_name()
 # ==========================================
 # コンテンツ抽出・解析
 # ==========================================
+def load_caption_cache():
+    """保存済みの画像キャプションを読み込む"""
+    try:
+        with open(CAPTION_CACHE_PATH, encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+caption_cache = load_caption_cache()
+_caption_cache_lock = threading.Lock()
+
+# 並列処理中の全PDFで共有するGeminiリクエスト枠
+_gemini_slots = threading.BoundedSemaphore(GEMINI_CONCURRENCY)
+
+def update_caption_cache(new_captions):
+    """キャプションを追加して保存する (並列処理中のPDF間で共有)"""
+    with _caption_cache_lock:
+        caption_cache.update(new_captions)
+        with open(CAPTION_CACHE_PATH, 'w', encoding='utf-8') as f:
+            json.dump(caption_cache, f, ensure_ascii=False, indent=2)
+
+_temp_images_lock = threading.Lock()
+
+def evict_temp_images():
+    """temp_images の画像がMAX_TEMP_IMAGESを超えたら、最終使用が古いものから削除する"""
+    # 並列処理中の他のPDFと同時に削除しないよう排他する
+    with _temp_images_lock:
+        files = []
+        for p in Path(DIRS['temp_img']).iterdir():
+            try:
+                if p.is_file(): files.append((p.stat().st_mtime, p))
+            except FileNotFoundError:
+                continue  # 走査中に消えたファイルは無視
+        if len(files) <= MAX_TEMP_IMAGES: return
+        files.sort(key=lambda f: f[0])
+        for _, p in files[:len(files) - MAX_TEMP_IMAGES]:
+            p.unlink(missing_ok=True)
+
+def downscale_image(base_image, source_name):
+    """長辺がMAX_IMAGE_EDGEを超える画像をJPEGに縮小し、(バイト列, 拡張子, 幅, 高さ) を返す"""
+    image_bytes, ext = base_image["image"], base_image["ext"]
+    width, height = base_image["width"], base_image["height"]
+    if max(width, height) <= MAX_IMAGE_EDGE:
+        return image_bytes, ext, width, height
+
+    try:
+        pix = fitz.Pixmap(image_bytes)
+        # JPEGはアルファ・CMYK非対応のため変換
+        if pix.alpha: pix = fitz.Pixmap(pix, 0)
+        if pix.n > 3: pix = fitz.Pixmap(fitz.csRGB, pix)
+        scale = MAX_IMAGE_EDGE / max(pix.width, pix.height)
+        pix = fitz.Pixmap(pix, int(pix.width * scale), int(pix.height * scale), None)
+        return pix.tobytes("jpeg", jpg_quality=85), "jpeg", pix.width, pix.height
+    except Exception as e:
+        print(f"  - [{source_name}] 画像縮小スキップ: {e}")
+        return image_bytes, ext, width, height
+
+def ensure_supported_format(image_bytes, ext):
+    """Geminiが受け付けない形式 (jpx, jb2, tiff など) の画像をPNGに変換し、(バイト列, 拡張子) を返す"""
+    if ext in GEMINI_IMAGE_EXTS:
+        return image_bytes, ext
+    pix = fitz.Pixmap(image_bytes)
+    # PNGはCMYK非対応のためRGBに変換
+    if pix.n - pix.alpha > 3: pix = fitz.Pixmap(fitz.csRGB, pix)
+    return pix.tobytes("png"), "png"
+
+async def caption_images(items):
+    """画像キャプションを並列生成する (失敗分は例外オブジェクトを返す)"""
+    sem = asyncio.Semaphore(GEMINI_CONCURRENCY)
+    # キャプション専用モデル (システムメッセージを送らないため変換は不要)
+    # 非同期クライアントはイベントループに紐づくため asyncio.run ごとに1つ生成し、
+    # gather 内の全リクエストでその接続を使い回す
+    llm_vision = ChatGoogleGenerativeAI(
+        model=MODEL_NAME,
+        temperature=0,
+        google_api_key=API_KEY
+    )
+
+    async def caption(item):
+        # base64化せず生のバイト列と実際のMIMEタイプで渡す
+        msg = HumanMessage(content=[
+            {"type": "text", "text": f"この画像（{item['label']}）は何の画像ですか？15文字以内で簡潔に答えてください。"},
+            {"type": "media", "data": item['bytes'], "mime_type": f"image/{item['ext']}"}
+        ])
+        async with sem:
+            # 全PDF共通の枠を取得 (待機でイベントループを止めないよう別スレッドで待つ)
+            await asyncio.to_thread(_gemini_slots.acquire)
+            try:
+                res = await llm_vision.ainvoke([msg])
+            finally:
+                _gemini_slots.release()
+        return res.content.strip()
+
+    return await asyncio.gather(*(caption(x) for x in items), return_exceptions=True)
+
 def extract_content_from_pdf(pdf_path):
-    doc = fitz.open(pdf_path)
-    full_text = ""
+    # ファイルを一括で読み込み、メモリ上のバイト列からドキュメントを開く
+    with open(pdf_path, "rb") as f:
+        doc = fitz.open(stream=f.read(), filetype="pdf")
     image_data = {} 
     
-    print(f"🔍 解析開始: {Path(pdf_path).name}")
+    source_name = Path(pdf_path).name
+    print(f"🔍 解析開始: {source_name}")
 
+    # ページを一度だけ走査し、テキストと画像xrefを同時に収集
+    text_parts = []
+    image_xrefs = []
+    seen_xrefs = set()  # 複数ページで共有される画像は一度だけ処理
     for page in doc:
-        full_text += page.get_text()
+        text_parts.append(page.get_text())
+        for img in page.get_images(full=True):
+            if img[0] not in seen_xrefs:
+                seen_xrefs.add(img[0])
+                image_xrefs.append(img[0])
+    full_text = "".join(text_parts)
 
-    print("🖼️ 画像解析中...")
-    shutil.rmtree(DIRS['temp_img'], ignore_errors=True)
-    Path(DIRS['temp_img']).mkdir(parents=True, exist_ok=True)
+    print(f"🖼️ 画像解析中: {source_name}")
 
+    # 1パス目: 画像の抽出 (ファイル保存はレポートで使われた画像のみ、save_referenced_images で行う)
+    pending = []
     img_count = 0
-    for page_index, page in enumerate(doc):
+    for xref in image_xrefs:
         if img_count >= MAX_IMAGES: break
-        image_list = page.get_images(full=True)
-        for img in image_list:
-            try:
-                xref = img[0]
-                base_image = doc.extract_image(xref)
-                image_bytes = base_image["image"]
-                
-                # 小さい画像は除外
-                if len(image_bytes) < 5000: continue 
-
-                img_filename = f"img_{img_count+1}.{base_image['ext']}"
-                img_path = os.path.join(DIRS['temp_img'], img_filename)
-                with open(img_path, "wb") as f:
-                    f.write(image_bytes)
-
-                # Geminiによる画像キャプション生成
-                img_b64 = base64.b64encode(image_bytes).decode('utf-8')
-                msg = HumanMessage(content=[
-                    {"type": "text", "text": f"この画像（図{img_count+1}）は何の画像ですか？15文字以内で簡潔に答えてください。"},
-                    {"type": "image_url", "image_url": f"data:image/png;base64,{img_b64}"}
-                ])
-                res = llm.invoke([msg])
-                
-                label = f"図{img_count+1}"
-                image_data[label] = {
-                    "path": img_path,
-                    "caption": res.content.strip(),
-                    "label": label
-                }
-                img_count += 1
-                print(f"  - {label} 検出: {res.content.strip()}")
-            except Exception as e:
-                print(f"  - 画像スキップ: {e}")
+        try:
+            base_image = doc.extract_image(xref)
+            image_bytes = base_image["image"]
+            
+            # 小さい画像は除外
+            if len(image_bytes) < 5000: continue 
+
+            # 内容のハッシュをファイル名・キャプションキャッシュのキーにする (PDF間で共通の画像を再利用)
+            img_hash = hashlib.sha1(image_bytes).hexdigest()
+            image_bytes, ext, width, height = downscale_image(base_image, source_name)
+            image_bytes, ext = ensure_supported_format(image_bytes, ext)
+            pending.append({
+                "label": f"図{img_count+1}",
+                "hash": img_hash,
+                "path": os.path.join(DIRS['temp_img'], f"{img_hash}.{ext}"),
+                "bytes": image_bytes,
+                "ext": ext,
+                "width": width,
+                "height": height
+            })
+            img_count += 1
+        except Exception as e:
+            print(f"  - [{source_name}] 画像スキップ: {e}")
+
+    # 2パス目: Geminiによる画像キャプション生成 (並列、キャッシュ済みの画像は除く)
+    uncached = [item for item in pending if item['hash'] not in caption_cache]
+    captions = asyncio.run(caption_images(uncached))
+    new_captions = {}
+    for item, caption in zip(uncached, captions):
+        if isinstance(caption, Exception):
+            print(f"  - [{source_name}] 画像スキップ: {caption}")
+            continue
+        new_captions[item['hash']] = caption
+    if new_captions:
+        update_caption_cache(new_captions)
+
+    for item in pending:
+        caption = caption_cache.get(item['hash'])
+        if caption is None: continue
+        image_data[item['label']] = {**item, "caption": caption}
+        print(f"  - [{source_name}] {item['label']} 検出: {caption}")
 
     doc.close()
     img_list_text = "\n".join([f"{k}: {v['caption']}" for k, v in image_data.items()])
     return full_text, img_list_text, image_data
 
-def generate_summary(text_content, image_list_text):
+def save_referenced_images(markdown_text, image_data, source_name):
+    """レポート中で [[IMG: ...]] として参照された画像のみファイルに保存する
+
+    レポートは画像をメモリ上のバイト列から描画するため、保存は確認用で失敗しても処理は続行する
+    """
+    try:
+        labels = {m.strip().replace(" ", "") for m in _IMG_RE.findall(markdown_text)}
+        for label in labels & image_data.keys():
+            info = image_data[label]
+            if os.path.exists(info['path']):
+                os.utime(info['path'])  # 最終使用時刻を更新 (evict_temp_images の判定用)
+            else:
+                with open(info['path'], "wb") as f:
+                    f.write(info['bytes'])
+        evict_temp_images()
+    except Exception as e:
+        print(f"⚠️ [{source_name}] 画像ファイル保存スキップ: {e}")
+
+def generate_summary(text_content, image_list_text, source_name, summary_model=None):
     combined_content = f"""
     === ドキュメント全文 ===
     {text_content}
@@ -214,11 +393,20 @@ def generate_summary(text_content, image_list_text):
     {image_list_text}
     """
     
-    prompt_text = f"{SYSTEM_PROMPT}\n\n以下の情報を基に、省略せずに完全なレポートを作成してください。\n\n{combined_content}"
+    request_text = f"以下の情報を基に、省略せずに完全なレポートを作成してください。\n\n{combined_content}"
     
-    print(f"🚀 AI生成開始...")
-    response = llm.invoke(prompt_text)
-    return response.content
+    print(f"🚀 AI生成開始: {source_name}")
+    with _gemini_slots:
+        if summary_model:
+            # SYSTEM_PROMPTはキャッシュ済みのため、可変部分のみ送信
+            try:
+                response = summary_model.generate_content(request_text)
+                return response.text
+            except Exception as e:
+                print(f"⚠️ [{source_name}] キャッシュ利用の生成に失敗したため通常生成に切り替えます: {e}")
+
+        response = llm.invoke(f"{SYSTEM_PROMPT}\n\n{request_text}")
+        return response.content
 
 # ==========================================
 # PDF生成 (ReportLab)
@@ -234,17 +422,15 @@ def parse_markdown_table(markdown_lines):
 def format_inline_bold(text):
     if not text: return ""
     # ReportLab用タグ修正
-    text = re.sub(r'<br\s*/?>', '<br/>', text, flags=re.IGNORECASE)
-    text = re.sub(r'\*\*(.*?)\*\*', r'<b>\1</b>', text)
+    text = _BR_RE.sub('<br/>', text)
+    text = _BOLD_RE.sub(r'<b>\1</b>', text)
     return text
 
 def create_paragraph_table(raw_data_lines, styles, available_width):
     if not raw_data_lines: return None
 
-    parsed_data = parse_markdown_table(raw_data_lines)
-    
-    # セパレータ行除去
-    clean_data = [row for row in parsed_data if not (len(row) > 0 and set("".join(row)).issubset({'-', ':', ' '}))]
+    # セパレータ行は save_to_pdf で読み込み時に除外済み
+    clean_data = parse_markdown_table(raw_data_lines)
     if not clean_data: return None
 
     # 列数正規化
@@ -307,17 +493,39 @@ def save_to_pdf(markdown_text, image_data_dict, original_filename):
     story.append(d_line)
     story.append(Spacer(1, 1*cm))
 
+    # 見出しは行頭トークン ("#"〜"####") で振り分ける
+    def emit_h1(text):
+        if len(story) > 5: story.append(PageBreak())
+        d_h1 = Drawing(available_width, 1)
+        d_h1.add(Line(0, 0, available_width, 0, strokeColor=colors.grey, strokeWidth=1))
+        story.append(KeepTogether([
+            Spacer(1, 0.5*cm),
+            Paragraph(text, style_h1),
+            d_h1,
+            Spacer(1, 0.3*cm)
+        ]))
+
+    header_handlers = {
+        '#': emit_h1,
+        '##': lambda text: story.append(Paragraph(text, style_h2)),
+        '###': lambda text: story.append(Paragraph(text, style_h3)),
+        '####': lambda text: story.append(Paragraph(f"<b>{text}</b>", style_body)),
+    }
+
     lines = markdown_text.split('\n')
     table_buffer = []
     in_table = False
 
     for line in lines:
         line = line.strip()
+        head = line[:1]  # 行頭1文字で処理を振り分ける
         
         # テーブル処理
-        if line.startswith('|'):
+        if head == '|':
             in_table = True
-            table_buffer.append(line)
+            # セパレータ行は生の文字列のまま判定して除外
+            if not _TABLE_SEP_CHARS.issuperset(line):
+                table_buffer.append(line)
             continue
         else:
             if in_table:
@@ -332,61 +540,52 @@ def save_to_pdf(markdown_text, image_data_dict, original_filename):
         if not line: continue
 
         # 画像タグ処理
-        img_match = re.match(r'\[\[IMG:\s*(.*?)\]\]', line)
-        if img_match:
-            label_key = img_match.group(1).strip().replace(" ", "")
-            if label_key in image_data_dict:
-                info = image_data_dict[label_key]
-                try:
-                    im = PDFImage(info['path'])
-                    # サイズ調整
-                    max_w, max_h = available_width, 10*cm 
-                    img_w, img_h = im.imageWidth, im.imageHeight
-                    aspect = img_h / float(img_w)
+        if head == '[':
+            img_match = _IMG_RE.match(line)
+            if img_match:
+                label_key = img_match.group(1).strip().replace(" ", "")
+                if label_key in image_data_dict:
+                    info = image_data_dict[label_key]
+                    try:
+                        # サイズ調整 (抽出時の寸法を使い、ReportLab側での再デコードを避ける)
+                        max_w, max_h = available_width, 10*cm 
+                        img_w, img_h = info['width'], info['height']
+                        aspect = img_h / float(img_w)
                     
-                    if img_w > max_w:
-                        img_w = max_w
-                        img_h = img_w * aspect
-                    if img_h > max_h:
-                        img_h = max_h
-                        img_w = img_h / aspect
+                        if img_w > max_w:
+                            img_w = max_w
+                            img_h = img_w * aspect
+                        if img_h > max_h:
+                            img_h = max_h
+                            img_w = img_h / aspect
                         
-                    im.drawWidth = img_w
-                    im.drawHeight = img_h
+                        im = PDFImage(BytesIO(info['bytes']), width=img_w, height=img_h)
                     
-                    story.append(KeepTogether([
-                        Spacer(1, 0.2*cm),
-                        im,
-                        Spacer(1, 0.1*cm),
-                        Paragraph(f"▲ {info['caption']}", style_caption),
-                        Spacer(1, 0.5*cm)
-                    ]))
-                except Exception as e:
-                    print(f"画像描画エラー: {e}")
-            continue
+                        story.append(KeepTogether([
+                            Spacer(1, 0.2*cm),
+                            im,
+                            Spacer(1, 0.1*cm),
+                            Paragraph(f"▲ {info['caption']}", style_caption),
+                            Spacer(1, 0.5*cm)
+                        ]))
+                    except Exception as e:
+                        print(f"画像描画エラー ({original_filename}): {e}")
+                continue
 
         # テキスト処理
-        if line.startswith('# '):
-            if len(story) > 5: story.append(PageBreak())
-            text = line.replace('# ', '').strip()
-            d_h1 = Drawing(available_width, 1)
-            d_h1.add(Line(0, 0, available_width, 0, strokeColor=colors.grey, strokeWidth=1))
-            story.append(KeepTogether([
-                Spacer(1, 0.5*cm),
-                Paragraph(text, style_h1),
-                d_h1,
-                Spacer(1, 0.3*cm)
-            ]))
-        elif line.startswith('## '):
-            story.append(Paragraph(line.replace('## ', '').strip(), style_h2))
-        elif line.startswith('### '):
-            story.append(Paragraph(line.replace('### ', '').strip(), style_h3))
-        elif line.startswith('#### '):
-            story.append(Paragraph(f"<b>{line.replace('#### ', '').strip()}</b>", style_body))
-        elif line.startswith('- ') or line.startswith('* '):
+        if head == '#':
+            prefix, _, rest = line.partition(' ')
+            rest = rest.strip()
+            handler = header_handlers.get(prefix)
+            # 見出し記号だけの行 ("#" など) は本文として扱う
+            if handler and rest:
+                handler(rest)
+                continue
+        elif line[:2] in ('- ', '* '):
             story.append(Paragraph(f"• {format_inline_bold(line[2:])}", style_bullet))
-        else:
-            story.append(Paragraph(format_inline_bold(line), style_body))
+            continue
+
+        story.append(Paragraph(format_inline_bold(line), style_body))
 
     if in_table and table_buffer:
         t = create_paragraph_table(table_buffer, styles, available_width)
@@ -397,7 +596,7 @@ def save_to_pdf(markdown_text, image_data_dict, original_filename):
         print(f"💾 PDF保存完了: {output_path}")
         return True
     except Exception as e:
-        print(f"❌ PDF保存エラー: {e}")
+        print(f"❌ PDF保存エラー ({original_filename}): {e}")
         import traceback
         traceback.print_exc()
         return False
@@ -405,26 +604,35 @@ def save_to_pdf(markdown_text, image_data_dict, original_filename):
 # ==========================================
 # メイン処理
 # ==========================================
+def process_one(pdf_file, summary_model):
+    """1つのPDFをレポート化し、処理済みフォルダへ移動する"""
+    try:
+        text, img_list, img_data = extract_content_from_pdf(str(pdf_file))
+        summary = generate_summary(text, img_list, pdf_file.name, summary_model)
+        
+        if save_to_pdf(summary, img_data, pdf_file.name):
+            save_referenced_images(summary, img_data, pdf_file.name)
+            new_path = Path(DIRS['processed']) / pdf_file.name
+            if new_path.exists(): os.remove(new_path)
+            shutil.move(str(pdf_file), str(new_path))
+            
+    except Exception as e:
+        print(f"Error ({pdf_file.name}): {e}")
+        import traceback
+        traceback.print_exc()
+
 def main():
     input_files = list(Path(DIRS['input']).glob('*.pdf'))
     if not input_files:
         print("ファイルが見つかりません。data/input_PDF を確認してください。")
         return
 
-    for pdf_file in input_files:
-        try:
-            text, img_list, img_data = extract_content_from_pdf(str(pdf_file))
-            summary = generate_summary(text, img_list)
-            
-            if save_to_pdf(summary, img_data, pdf_file.name):
-                new_path = Path(DIRS['processed']) / pdf_file.name
-                if new_path.exists(): os.remove(new_path)
-                shutil.move(str(pdf_file), str(new_path))
-                
-        except Exception as e:
-            print(f"Error: {e}")
-            import traceback
-            traceback.print_exc()
+    # 処理対象がある場合のみコンテキストキャッシュを用意し、全PDFで共有する
+    summary_model = create_summary_model()
+
+    # PDFごとの処理は独立しているため並列実行
+    with concurrent.futures.ThreadPoolExecutor(max_workers=PDF_WORKERS) as ex:
+        list(ex.map(lambda f: process_one(f, summary_model), input_files))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
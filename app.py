@@ -1,8 +1,12 @@
 import os
 import glob
+import time
+import hashlib
 import numpy as np
+import faiss
 import google.generativeai as genai
 from pypdf import PdfReader
+from langchain_text_splitters import RecursiveCharacterTextSplitter
 from dotenv import load_dotenv
 # .envファイルの読み込み
 load_dotenv()
@@ -22,6 +26,33 @@ GENERATION_MODEL = "gemini-2.0-flash"
 # PDFフォルダ
 PDF_DIR = os.path.join("data", "output_PDF")
 
+# チャンク分割の設定 (段落 → 行 → 文 → 読点 → 空白 → 文字 の順に区切りを探す)
+CHUNK_SIZE = 500
+CHUNK_OVERLAP = 80
+text_splitter = RecursiveCharacterTextSplitter(
+    chunk_size=CHUNK_SIZE,
+    chunk_overlap=CHUNK_OVERLAP,
+    separators=["\n\n", "\n", "。", "、", " ", ""],
+    keep_separator="end"  # 句読点は前の文の末尾に残す
+)
+
+# チャンクとベクトルの保存先 (PDFが更新されていなければ再計算しない)
+INDEX_PATH = os.path.join("data", "rag_index.npz")
+FAISS_INDEX_PATH = os.path.join("data", "rag_index.faiss")
+
+# チャンク分割・インデックス形式を変更したら上げる (保存済みインデックスを作り直す)
+INDEX_VERSION = 2  # 2: FAISSインデックスをfloat16 (ScalarQuantizer) 形式に変更
+
+# チャンク数がこれを超えたら総当たり (IndexFlatIP) ではなく近似検索 (HNSW) を使う
+HNSW_THRESHOLD = 50000
+
+# embed_content 1リクエストあたりのチャンク数
+EMBEDDING_BATCH_SIZE = 100
+
+# 同じ質問への応答を再利用する期間 (秒) と保持件数の上限
+RESPONSE_CACHE_TTL = 1800
+RESPONSE_CACHE_MAX = 256
+
 # RAGを使用する類似度の閾値 (0.0〜1.0)
 # この値を調整することで「関連性が高い」の判定基準を変えられます
 SIMILARITY_THRESHOLD = 0.6
@@ -33,6 +64,9 @@ character{name, personality, tone}:
 GeminiBot, Helpful and intelligent assistant, Polite and concise
 """
 
+# 応答キャッシュ {(設定, RAG資料, 会話履歴, 質問) のハッシュ: (保存時刻, 応答テキスト)}
+_resp_cache = {}
+
 # ==========================================
 # 関数定義: PDF処理 & RAG関連
 # ==========================================
@@ -53,14 +87,13 @@ def load_pdfs(directory):
     for file_path in files:
         try:
             reader = PdfReader(file_path)
-            text = ""
+            text_parts = []
             for page in reader.pages:
-                text += page.extract_text() + "\n"
+                text_parts.append(page.extract_text())
+            text = "\n".join(text_parts) + "\n"
             
-            # 簡易的なチャンク分割 (500文字区切り)
-            chunk_size = 500
-            for i in range(0, len(text), chunk_size):
-                chunk = text[i:i+chunk_size]
+            # 段落・文の区切りを優先してチャンク分割
+            for chunk in text_splitter.split_text(text):
                 if len(chunk) > 50: # 短すぎるノイズは除外
                     documents.append(chunk)
         except Exception as e:
@@ -77,26 +110,87 @@ def get_embedding(text):
     )
     return result['embedding']
 
-def find_relevant_docs(query, documents, doc_embeddings):
+def embed_documents(documents):
+    """ドキュメントをバッチ単位でベクトル化する"""
+    doc_embeddings = []
+    for i in range(0, len(documents), EMBEDDING_BATCH_SIZE):
+        batch = documents[i:i+EMBEDDING_BATCH_SIZE]
+        # embeddingのtask_typeはdocumentにする
+        result = genai.embed_content(model=EMBEDDING_MODEL, content=batch, task_type="retrieval_document")
+        doc_embeddings.extend(result['embedding'])
+    return np.asarray(doc_embeddings, dtype=np.float32)
+
+def build_manifest(directory):
+    """インデックスの有効性判定に使うPDF一覧 (パス, 更新時刻, サイズ) を作成する"""
+    files = sorted(glob.glob(os.path.join(directory, "*.pdf")))
+    return [(f, os.path.getmtime(f), os.path.getsize(f)) for f in files]
+
+def build_search_index(doc_embeddings):
+    """ベクトルを正規化し、内積 (=コサイン類似度) で検索するFAISSインデックスを作成する
+
+    ベクトルはfloat16で保持し (メモリ・帯域を半減)、類似度計算はfloat32で行う
+    """
+    emb = np.ascontiguousarray(doc_embeddings, dtype=np.float32)
+    faiss.normalize_L2(emb)
+    fp16 = faiss.ScalarQuantizer.QT_fp16
+    if len(emb) > HNSW_THRESHOLD:
+        search_index = faiss.IndexHNSWSQ(emb.shape[1], fp16, 32, faiss.METRIC_INNER_PRODUCT)
+    else:
+        search_index = faiss.IndexScalarQuantizer(emb.shape[1], fp16, faiss.METRIC_INNER_PRODUCT)
+    if not search_index.is_trained:
+        search_index.train(emb)
+    search_index.add(emb)
+    return search_index
+
+def load_index(manifest):
+    """保存済みインデックスを読み込み (チャンク, FAISSインデックス) を返す。PDFが変更されていればNoneを返す"""
+    if not manifest or not os.path.exists(INDEX_PATH):
+        return None
+    try:
+        # NpzFileは開いたファイルを保持するため、withで確実に閉じる (保存時の上書きを妨げない)
+        with np.load(INDEX_PATH, allow_pickle=True) as index:
+            if [tuple(m) for m in index['manifest'].tolist()] != manifest:
+                return None
+            # チャンク分割の設定・インデックス形式が変わった場合も作り直す
+            if 'chunking' not in index.files or index['chunking'].tolist() != [INDEX_VERSION, CHUNK_SIZE, CHUNK_OVERLAP]:
+                return None
+            docs = index['docs'].tolist()
+            if os.path.exists(FAISS_INDEX_PATH):
+                search_index = faiss.read_index(FAISS_INDEX_PATH)
+                # 旧形式 (float32の IndexFlatIP / IndexHNSWFlat) は使わずに再構築する
+                is_fp16 = isinstance(search_index, (faiss.IndexScalarQuantizer, faiss.IndexHNSWSQ))
+                if is_fp16 and search_index.ntotal == len(docs):
+                    return docs, search_index
+            # FAISSインデックスが無い・不整合の場合は保存済みベクトルから再構築
+            search_index = build_search_index(index['emb'].astype(np.float32))
+            faiss.write_index(search_index, FAISS_INDEX_PATH)
+            return docs, search_index
+    except Exception as e:
+        print(f"Error reading {INDEX_PATH}: {e}")
+        return None
+
+def save_index(manifest, documents, doc_embeddings, search_index):
+    """チャンクとベクトルをインデックスとして保存する (ベクトルはfloat16で保持)"""
+    np.savez_compressed(
+        INDEX_PATH,
+        docs=np.array(documents, dtype=object),
+        emb=doc_embeddings.astype(np.float16),
+        manifest=np.array(manifest, dtype=object),
+        chunking=np.array([INDEX_VERSION, CHUNK_SIZE, CHUNK_OVERLAP])
+    )
+    faiss.write_index(search_index, FAISS_INDEX_PATH)
+
+def find_relevant_docs(query, documents, search_index):
     """クエリに関連するドキュメントを検索する"""
     if not documents:
         return None, 0.0
 
-    query_embedding = get_embedding(query)
-    
-    # コサイン類似度の計算
-    scores = []
-    for doc_emb in doc_embeddings:
-        dot_product = np.dot(query_embedding, doc_emb)
-        norm_a = np.linalg.norm(query_embedding)
-        norm_b = np.linalg.norm(doc_emb)
-        score = dot_product / (norm_a * norm_b)
-        scores.append(score)
-    
-    max_score = max(scores)
-    best_idx = scores.index(max_score)
+    # インデックス側は正規化済みのため、内積がそのままコサイン類似度になる
+    q = np.asarray([get_embedding(query)], dtype=np.float32)
+    faiss.normalize_L2(q)
+    scores, ids = search_index.search(q, 1)
     
-    return documents[best_idx], max_score
+    return documents[ids[0, 0]], float(scores[0, 0])
 
 # ==========================================
 # 関数定義: TOONフォーマット変換
@@ -124,28 +218,64 @@ def format_history_toon(history_list):
         
     return toon_str
 
+# ==========================================
+# 関数定義: 応答生成
+# ==========================================
+
+def stream_reply(model, prompt):
+    """応答をストリーミングで表示しながら生成する (テキストを1つも受信できなかった場合は通常生成で再試行)"""
+    chunks = []
+    try:
+        for chunk in model.generate_content(prompt, stream=True):
+            # finish_reason のみの最終チャンクや途中の安全停止など、本文を持たないチャンクは読み飛ばす
+            if not chunk.parts: continue
+            print(chunk.text, end="", flush=True)
+            chunks.append(chunk.text)
+    except Exception as e:
+        # 途中まで受信済みの場合は、その内容を応答として扱う
+        if chunks: print(f"\n(応答が途中で終了しました: {e})", end="")
+
+    if not chunks:
+        # 本文を1つも受信できなかった場合は通常生成で再試行
+        reply_text = model.generate_content(prompt).text.strip()
+        print(reply_text)
+        return reply_text
+
+    print()
+    return "".join(chunks).strip()
+
 # ==========================================
 # メインループ
 # ==========================================
 
 def main():
-    # 1. PDF読み込みとベクトル化（起動時に一度だけ実行）
-    docs = load_pdfs(PDF_DIR)
-    doc_embeddings = []
+    # 1. PDF読み込みとベクトル化（起動時に一度だけ実行、PDFに変更がなければ保存済みインデックスを使用）
+    manifest = build_manifest(PDF_DIR)
+    index = load_index(manifest)
+    if index:
+        docs, search_index = index
+        print(f"Loaded {len(docs)} document chunks from {INDEX_PATH}")
+    else:
+        docs = load_pdfs(PDF_DIR)
+        search_index = None
+        if docs:
+            print(f"Embedding {len(docs)} document chunks... (Please wait)")
+            doc_embeddings = embed_documents(docs)
+            search_index = build_search_index(doc_embeddings)
+            save_index(manifest, docs, doc_embeddings, search_index)
+
     if docs:
-        print(f"Embedding {len(docs)} document chunks... (Please wait)")
-        # バッチ処理ではなくシンプルにループで処理
-        for doc in docs:
-            # embeddingのtask_typeはdocumentにする
-            emb = genai.embed_content(model=EMBEDDING_MODEL, content=doc, task_type="retrieval_document")['embedding']
-            doc_embeddings.append(emb)
         print("Ready!")
     else:
         print("No PDFs found or processed. Running in standard mode.")
 
     # 会話履歴の保持
     history = []
-    model = genai.GenerativeModel(GENERATION_MODEL)
+    # キャッシュした応答と新たに生成した応答の差が小さくなるよう temperature=0 にする
+    model = genai.GenerativeModel(
+        GENERATION_MODEL,
+        generation_config=genai.GenerationConfig(temperature=0)
+    )
 
     print("\n--- Chatbot Started (type 'exit' to quit) ---")
 
@@ -159,7 +289,7 @@ def main():
         is_rag_used = False
         
         if docs:
-            best_doc, score = find_relevant_docs(user_input, docs, doc_embeddings)
+            best_doc, score = find_relevant_docs(user_input, docs, search_index)
             
             # 閾値を超えた場合のみRAGを使用
             if score >= SIMILARITY_THRESHOLD:
@@ -196,14 +326,24 @@ Output only the response text.
 
         # --- 生成実行 ---
         try:
-            response = model.generate_content(prompt)
-            reply_text = response.text.strip()
+            # 同じ質問・参照資料・会話履歴の組み合わせが有効期間内にあればAPIを呼ばずに再利用
+            # (「もっと詳しく」のような文脈依存の質問に別の会話の応答を返さないよう、履歴もキーに含める)
+            key_source = "\0".join([CHARACTER_SETTINGS, rag_context, history_toon, user_input.strip()])
+            key = hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+            cached = _resp_cache.get(key)
 
             # --- 出力整形 ---
-            if is_rag_used:
-                print(f"chat : (RAG) {reply_text}")
+            print("chat : (RAG) " if is_rag_used else "chat : ", end="", flush=True)
+            if cached and time.time() - cached[0] < RESPONSE_CACHE_TTL:
+                reply_text = cached[1]
+                print(reply_text)
             else:
-                print(f"chat : {reply_text}")
+                reply_text = stream_reply(model, prompt)
+                _resp_cache.pop(key, None)
+                _resp_cache[key] = (time.time(), reply_text)
+                # 上限を超えたら古いものから削除 (dictは挿入順を保持)
+                while len(_resp_cache) > RESPONSE_CACHE_MAX:
+                    del _resp_cache[next(iter(_resp_cache))]
 
             # 履歴に追加
             history.append({"role": "user", "content": user_input})